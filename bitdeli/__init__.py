@@ -16,11 +16,13 @@ The :mod:`bitdeli` module supports a straightforward imperative coding style aka
 """
 import os
 from datetime import datetime, timedelta
-from types import DictType
+from types import DictType, ListType, TupleType
+from collections import Mapping
 from fields import Event
 
-from protocol import output, entries, params
-from bencode import encoder_alias, BenJson
+from protocol import output, entries, params, OutputBuffer
+from bencode import encoder_alias, bencode, BenJson, decode_func, skip,\
+                    intern_str
 from chunkedlist import ChunkedList
 from cbencode import Decoder
 
@@ -33,6 +35,18 @@ if 'TESTING' not in os.environ:
 
 GROUP_FORMAT = '%Y-%m-%d'
 
+# expiry dates by days, PARAMS['group'] doesn't change during a run
+_expire_dates = {}
+
+def _expire_date(days):
+    try:
+        return _expire_dates[days]
+    except KeyError:
+        t = PARAMS['group'][:10]
+        expires = datetime.strptime(t, GROUP_FORMAT) + timedelta(days=days)
+        date = _expire_dates[days] = datetime.strftime(expires, GROUP_FORMAT)
+        return date
+
 class Profile(dict):
     """
     The :class:`Profile` object is inherited from `the standard Python dictionary <http://docs.python.org/2/library/stdtypes.html#mapping-types-dict>`_. You can use any dictionary methods to access the fields in this :ref:`profile <profiles>`.
@@ -41,28 +55,208 @@ class Profile(dict):
 
     The field **uid** contains the unique identifier of this profile.
     """
-    def __init__(self, entry):
+    def __init__(self, entry, track_changes=False, intern=False):
         uid, data = entry
         self.uid = uid
+        if intern:
+            data = _interned_items(data)
         super(Profile, self).__init__(data)
+        self._changed = False
+        self._snapshot = self._containers() if track_changes else None
+
+    def _containers(self):
+        # values that may be modified in place
+        return bencode(dict((k, v) for k, v in self.iteritems()\
+                            if type(v) in (DictType, ListType, TupleType)))
+
+    def changed(self):
+        """
+        Returns *False* if the profile has certainly not been modified
+        since it was created with *track_changes=True*.
+        """
+        if self._changed or self._snapshot is None:
+            return True
+        for value in self.itervalues():
+            if isinstance(value, ChunkedList) and value.changed():
+                return True
+        return self._snapshot != self._containers()
+
+    def __setitem__(self, key, value):
+        if not (key in self and self[key] == value):
+            self._changed = True
+        super(Profile, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._changed = True
+        super(Profile, self).__delitem__(key)
+
+    def clear(self):
+        self._changed = True
+        super(Profile, self).clear()
+
+    def pop(self, *args):
+        self._changed = True
+        return super(Profile, self).pop(*args)
+
+    def popitem(self):
+        self._changed = True
+        return super(Profile, self).popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._changed = True
+        return super(Profile, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._changed = True
+        super(Profile, self).update(*args, **kwargs)
 
     def set_expire(self, days):
-        t = PARAMS['group'][:10]
-        expires = datetime.strptime(t, GROUP_FORMAT) + timedelta(days=days)
-        self['!!expires'] = datetime.strftime(expires, GROUP_FORMAT)
+        self['!!expires'] = _expire_date(days)
 
-    def close(self):
-        output([(self.uid, self)])
+    def close(self, out=None):
+        if not self.changed():
+            return
+        if out is None:
+            output([(self.uid, self)])
+        else:
+            out.append((self.uid, self))
 
+def _interned_items(data):
+    # cbencode.Decoder doesn't intern strings: intern the short keys and
+    # string values of profile data through the bencode intern table
+    for key, value in data.iteritems():
+        yield intern_str(key), intern_str(value)
 
-def profiles():
+class LazyProfile(Mapping):
+    """
+    A read-only alternative to :class:`Profile` that keeps the profile
+    encoded and decodes each field only when it is first accessed. Use
+    :func:`profiles` with *lazy=True* to instantiate the object.
+
+    The field **uid** contains the unique identifier of this profile.
+    """
+    def __init__(self, entry):
+        self.uid, (self._buf, self._start, self._decoder) = entry
+        self._index = None
+        self._values = {}
+
+    def _keys(self):
+        if self._index is None:
+            self._index = self._scan()
+        return self._index
+
+    def _scan(self):
+        buf = self._buf
+        index = {}
+        f = self._start + 1
+        while buf[f] != 'e':
+            key, f = decode_func[buf[f]](buf, f)
+            end = skip(buf, f)
+            index[key] = f, end
+            f = end
+        return index
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            start, end = self._keys()[key]
+            value = self._decoder.decode(buffer(self._buf, start, end - start))
+            self._values[key] = value
+            return value
+
+    def __contains__(self, key):
+        return key in self._keys()
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __reduce__(self):
+        return (Profile, ((self.uid, dict(self)),))
+
+class LazyDecoder(object):
+    # Decodes a batch of entries for LazyProfile: Only the uid of
+    # each entry is decoded, the profile data is left encoded. The reply
+    # is scanned in place and each profile gets a copy of its own data,
+    # so profiles that are kept don't keep the whole batch in memory.
+    def __init__(self, decoder):
+        self.decoder = decoder
+
+    def _data(self, buf, f):
+        end = skip(buf, f)
+        return (buf[f:end], 0, self.decoder), end
+
+    def decode(self, reply):
+        return self.decoder.decode(reply)
+
+    def decode_iter(self, reply):
+        buf = reply
+        f = 1
+        while buf[f] != 'e':
+            if buf[f + 1] == 'e':
+                # end of entries
+                yield []
+                f += 2
+            else:
+                # [did, [uid, data]]
+                did, f = decode_func[buf[f + 1]](buf, f + 1)
+                uid, f = decode_func[buf[f + 1]](buf, f + 1)
+                data, f = self._data(buf, f)
+                yield did, (uid, data)
+                f += 2
+
+class ProjectingDecoder(LazyDecoder):
+    # Decodes only the given fields of profile data to a dictionary,
+    # other fields are skipped without decoding.
+    def __init__(self, decoder, fields):
+        super(ProjectingDecoder, self).__init__(decoder)
+        self.fields = frozenset(fields)
+
+    def _data(self, buf, f):
+        data = {}
+        f += 1
+        while buf[f] != 'e':
+            key, f = decode_func[buf[f]](buf, f)
+            end = skip(buf, f)
+            if key in self.fields:
+                data[key] = self.decoder.decode(buffer(buf, f, end - f))
+            f = end
+        return data, f + 1
+
+def profiles(prefetch=0, lazy=False, fields=None, intern=False):
     """
     Returns an iterator that iterates over :ref:`profiles`.
 
-    Each profile is a :class:`Profile` object.
+    Each profile is a :class:`Profile` object, or a :class:`LazyProfile`
+    object if *lazy* is *True*.
+
+    If *prefetch* is larger than zero, up to *prefetch* batches of profiles
+    are read ahead in the background while the current batch is processed.
+
+    If *fields* is given, only the listed fields are decoded to each
+    :class:`Profile`, e.g. `profiles(fields=Profiles.fields())`. In this
+    case *lazy* has no effect.
+
+    If *intern* is *True*, short field names and string values of each
+    :class:`Profile` are shared between profiles, which saves memory when
+    many profiles are kept, e.g. by :class:`bitdeli.chain.List`.
     """
-    for did, entry in entries():
-        yield Profile(entry)
+    if fields is not None:
+        decoder = ProjectingDecoder(Decoder(lazylist_obj=ChunkedList), fields)
+        for did, entry in entries(decoder, prefetch=prefetch):
+            yield Profile(entry, intern=intern)
+    elif lazy:
+        decoder = LazyDecoder(Decoder(lazylist_obj=ChunkedList))
+        for did, entry in entries(decoder, prefetch=prefetch):
+            yield LazyProfile(entry)
+    else:
+        decoder = Decoder(lazylist_obj=ChunkedList)
+        for did, entry in entries(decoder, prefetch=prefetch):
+            yield Profile(entry, intern=intern)
 
 #
 # used by profile scripts
@@ -77,12 +271,16 @@ def profile_events():
             else:
                 yield Event._make(entry)
     entries_iter = entries(decoder)
-    for did, profile_data in entries_iter:
-        profile = Profile(profile_data)
-        events = events_iter(entries_iter)
-        yield profile, events
-        for event in events:
-            pass
-        profile.close()
+    out = OutputBuffer()
+    try:
+        for did, profile_data in entries_iter:
+            profile = Profile(profile_data, track_changes=True)
+            events = events_iter(entries_iter)
+            yield profile, events
+            for event in events:
+                pass
+            profile.close(out)
+    finally:
+        out.flush()
 
 encoder_alias(Profile, DictType)
@@ -18,9 +18,17 @@ try:
 except ImportError:
     pass
 
+def find(x, c, f):
+    # x.index(c, f) that works for buffers too
+    if type(x) is str:
+        return x.index(c, f)
+    while x[f] != c:
+        f += 1
+    return f
+
 def decode_int(x, f):
     f += 1
-    newf = x.index('e', f)
+    newf = find(x, 'e', f)
     n = int(x[f:newf])
     if x[f] == '-':
         if x[f + 1] == '0':
@@ -45,7 +53,7 @@ def decode_benjson(x, f):
     return (BenJson(s), f)
 
 def decode_string(x, f):
-    colon = x.index(':', f)
+    colon = find(x, ':', f)
     n = int(x[f:colon])
     if x[f] == '0' and colon != f+1:
         raise ValueError
@@ -59,11 +67,33 @@ def decode_list(x, f):
         r.append(v)
     return (r, f + 1)
 
+# Short str keys and values of dicts are shared through a bounded intern
+# table: strings seen after the table is full are not interned.
+MAX_INTERNED = 65536
+MAX_INTERN_LENGTH = 32
+interned = {}
+
+def intern_str(s):
+    if type(s) is not str or len(s) > MAX_INTERN_LENGTH:
+        return s
+    try:
+        return interned[s]
+    except KeyError:
+        if len(interned) < MAX_INTERNED:
+            interned[s] = s
+        return s
+
 def decode_dict(x, f):
     r, f = {}, f+1
+    shared = interned.get
     while x[f] != 'e':
         k, f = decode_func[x[f]](x, f)
-        r[k], f = decode_func[x[f]](x, f)
+        v, f = decode_func[x[f]](x, f)
+        if type(k) is str and len(k) <= MAX_INTERN_LENGTH:
+            k = shared(k) or intern_str(k)
+        if type(v) is str and len(v) <= MAX_INTERN_LENGTH:
+            v = shared(v) or intern_str(v)
+        r[k] = v
     return (r, f + 1)
 
 def decode_compressed(x, f):
@@ -74,7 +104,36 @@ def decode_lazylist(x, f):
     s, f = decode_string(x, f+1)
     return BenLazyList(data=s), f
 
-def decompress(x):
+def decode_chunk(x, f):
+    # a ChunkedList chunk with an uncompressed header
+    from chunkedlist import chunk_data
+    from columnar import decode_events
+    end = find(x, ':', f) + 1
+    end += int(x[f+1:end-1])
+    header, data = chunk_data(x[f:end])
+    if header.get('fmt') == 'events':
+        data = bencode(decode_events(bdecode(data)))
+    return BenLazyList(data=data), end
+
+# codecs for compressed data: name -> (compress, decompress)
+codecs = {}
+
+def register_codec(name, compress, decompress):
+    codecs[name] = (compress, decompress)
+
+register_codec('zlib', lambda x: zlib.compress(x, 1), zlib.decompress)
+register_codec('snappy',
+               lambda x: snappy.compress(x),
+               lambda x: snappy.decompress(x))
+
+def compress(x, use_snappy=False, codec=None):
+    if codec is None:
+        codec = 'snappy' if use_snappy else 'zlib'
+    return codecs[codec][0](x)
+
+def decompress(x, codec=None):
+    if codec:
+        return codecs[codec][1](x)
     # Luckily \x78\x9c is an invalid preamble for Snappy:
     # If the block was 120 bytes, the preamble would be \x78\x00.
     # The first byte cannot be \x78 in any other case.
@@ -92,6 +151,7 @@ decode_func['j'] = decode_json
 decode_func['u'] = decode_unicode
 decode_func['z'] = decode_compressed
 decode_func['y'] = decode_lazylist
+decode_func['k'] = decode_chunk
 decode_func['0'] = decode_string
 decode_func['1'] = decode_string
 decode_func['2'] = decode_string
@@ -103,6 +163,25 @@ decode_func['7'] = decode_string
 decode_func['8'] = decode_string
 decode_func['9'] = decode_string
 
+def skip(x, f):
+    # Returns the offset after the value at f without decoding it
+    c = x[f]
+    if c == 'l' or c == 'd':
+        f += 1
+        while x[f] != 'e':
+            f = skip(x, f)
+        return f + 1
+    elif c == 'i':
+        return find(x, 'e', f) + 1
+    elif c == 'b':
+        return f + 2
+    else:
+        if not c.isdigit():
+            # prefixed strings, e.g. 'j' and 'z'
+            f += 1
+        colon = find(x, ':', f)
+        return colon + 1 + int(x[f:colon])
+
 def bdecode(x, benjson=False):
     try:
         decode_func['j'] = decode_benjson if benjson else decode_json
@@ -122,12 +201,11 @@ class BenCached(object):
         self.bencoded = s
 
 class BenCompressed(object):
+    # Note that compressed values are decompressed without knowing the
+    # codec, so only zlib and snappy data can be decoded.
     __slots__ = ['data']
     def __init__(self, s, use_snappy=False):
-        if use_snappy:
-            self.data = snappy.compress(bencode(s))
-        else:
-            self.data = zlib.compress(bencode(s), 1)
+        self.data = compress(bencode(s), use_snappy)
 
 class BenJson(object):
     __slots__ = ['data']
@@ -169,13 +247,78 @@ def encode_list(x, r):
         encode_func[type(i)](i, r)
     r.append('e')
 
+# Dicts with the same str keys share a schema: the sorted keys and
+# their encodings. Schemas are cached by the key order of the dict, for
+# dicts with at most MAX_SCHEMA_KEYS keys. If a window of SCHEMA_WINDOW
+# dicts sees MAX_SCHEMA_MISSES more misses than hits, the rest of the
+# window bypasses the cache.
+MAX_SCHEMA_KEYS = 64
+MAX_SCHEMAS = 10000
+MAX_SCHEMA_MISSES = 100
+SCHEMA_WINDOW = 10000
+schemas = {}
+registered_schemas = {}
+schema_stats = [0, 0, 0] # hits, misses, dicts in the window
+
+def str_keys(keys):
+    # join() returns unicode if any key is unicode and fails on other
+    # types, which is cheaper than checking the keys one by one
+    try:
+        return type(''.join(keys)) is str
+    except TypeError:
+        return False
+
+def compile_schema(keys):
+    return tuple((k, bencode(k)) for k in sorted(keys))
+
+def register_schema(keys):
+    """Compiles the schema of dicts with the given str keys, in any
+       order. Registered schemas are never evicted."""
+    keys = tuple(keys)
+    if not str_keys(keys):
+        raise ValueError("Schema keys must be strs")
+    schema = registered_schemas[frozenset(keys)] = compile_schema(keys)
+    return schema
+
+def find_schema(keys):
+    if not str_keys(keys):
+        schema_stats[1] += 1
+        return None
+    schema = schemas.get(keys)
+    if schema is None and registered_schemas:
+        schema = registered_schemas.get(frozenset(keys))
+        if schema is not None:
+            schemas[keys] = schema
+    if schema is None:
+        schema_stats[1] += 1
+        if len(schemas) >= MAX_SCHEMAS:
+            schemas.clear()
+        schema = schemas[keys] = compile_schema(keys)
+    else:
+        schema_stats[0] += 1
+    return schema
+
 def encode_dict(x,r):
     r.append('d')
-    ilist = x.items()
-    ilist.sort()
-    for k, v in ilist:
-        encode_func[type(k)](k, r)
-        encode_func[type(v)](v, r)
+    schema = None
+    if len(x) <= MAX_SCHEMA_KEYS:
+        hits, misses, num = schema_stats
+        if num >= SCHEMA_WINDOW:
+            schema_stats[:] = [0, 0, 0]
+        schema_stats[2] += 1
+        if misses - hits < MAX_SCHEMA_MISSES:
+            schema = find_schema(tuple(x))
+    if schema:
+        for k, ek in schema:
+            r.append(ek)
+            v = x[k]
+            encode_func[type(v)](v, r)
+    else:
+        ilist = x.items()
+        ilist.sort()
+        for k, v in ilist:
+            encode_func[type(k)](k, r)
+            encode_func[type(v)](v, r)
     r.append('e')
 
 encode_func = {}
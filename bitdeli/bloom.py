@@ -0,0 +1,39 @@
+import hashlib
+
+# Bloom filters for ChunkedList chunk headers
+#
+# A filter is a string: the number of hash functions as the first byte,
+# followed by the bit array. Bit positions are derived from the MD5 digest
+# of a key with double hashing, so filters are stable across processes
+# and platforms.
+
+BITS_PER_KEY = 10
+NUM_HASHES = 7
+
+def _positions(key, num_bits, num_hashes):
+    digest = hashlib.md5(key).digest()
+    h1 = int(digest[:8].encode('hex'), 16)
+    h2 = int(digest[8:].encode('hex'), 16) | 1
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+def make(keys, bits_per_key=BITS_PER_KEY, num_hashes=NUM_HASHES):
+    """
+    Returns a filter of the strings *keys*.
+    """
+    keys = set(keys)
+    num_bytes = max(8, (len(keys) * bits_per_key + 7) / 8)
+    bits = bytearray(num_bytes)
+    for key in keys:
+        for pos in _positions(key, num_bytes * 8, num_hashes):
+            bits[pos >> 3] |= 1 << (pos & 7)
+    return chr(num_hashes) + str(bits)
+
+def contains(bloom, key):
+    """
+    Returns *False* if *key* is certainly not in the filter *bloom*.
+    """
+    num_bits = (len(bloom) - 1) * 8
+    for pos in _positions(key, num_bits, ord(bloom[0])):
+        if not ord(bloom[1 + (pos >> 3)]) & (1 << (pos & 7)):
+            return False
+    return True
@@ -62,11 +62,26 @@ Note that method names are all lowercase, as in the example above.
 .. autoclass:: List
 .. autoclass:: Show
 
+Sharded Scans
+-------------
+
+With :func:`run_sharded`, the profiles are split to shards by their
+UID and each shard is scanned by a separate worker process. Each chain
+is split at its first *mergeable* operation, :class:`Classify`,
+:class:`List`, `describe` or a :class:`Map` with a *combine* function:
+Operations up to the mergeable one are run in the workers, their partial
+results are combined, and the rest of the chain is run as usual. Note that
+operations before the mergeable one see only a part of the profiles.
+
+.. autofunction:: run_sharded
+
 """
 from widgets import make_widget, line_number
 from functools import partial
 from collections import Counter, Callable
+from itertools import chain as chain_iter
 from uuid import uuid4
+import pipeline
 
 class Profiles(object):
     """
@@ -74,13 +89,23 @@ class Profiles(object):
     the first operator in the chain.
 
     Add a new instance of this class to the beginning of each chain.
+
+    Optionally, *fields* lists the profile fields used by the chain. If
+    all chains declare their fields, :meth:`fields` returns the fields
+    that need to be decoded from the profiles. The first operation of the
+    chain may declare its fields instead, e.g. *classify* and *describe*
+    accept a *fields* argument.
     """
     _num = [0]
     _pipelines = {}
+    _ops = {}
+    _fields = {}
 
-    def __init__(self):
+    def __init__(self, fields=None):
         self._id = 'chain-%d' % self._num[0]
         self._num[0] += 1
+        if fields is not None:
+            self.require(fields)
 
     def __getattr__(self, name):
         if name in OPS:
@@ -96,12 +121,38 @@ class Profiles(object):
         else:
             chain = op._iter
         self._pipelines[self._id] = chain
+        self._ops.setdefault(self._id, []).append(op)
+
+    def require(self, fields):
+        # Fields can be declared only before the first operation: later
+        # operations see items produced by the earlier ones, which may
+        # read any profile fields.
+        if self._id in self._pipelines:
+            raise ValueError("Fields can be declared only by Profiles() or "
+                             "the first operation of a chain")
+        self._fields.setdefault(self._id, set()).update(fields)
 
     @classmethod
     def pipelines(self):
         return self._pipelines.values()
 
+    @classmethod
+    def fields(self):
+        """
+        Returns a set of fields required by all chains, or *None* if some
+        chain doesn't declare its fields.
+        """
+        if any(chain_id not in self._fields for chain_id in self._pipelines):
+            return None
+        return set().union(*self._fields.values())
+
 class Op(object):
+    # Mergeable operations can be run over shards of profiles:
+    # _partial(it) consumes a shard and returns a partial state, and
+    # _combine(partials) combines the states and returns the output of
+    # the operation.
+    mergeable = False
+
     def __init__(self, parent):
         self.parent = parent
         parent.add(self)
@@ -114,7 +165,11 @@ class Op(object):
 #
 
 class Classify(Op):
-    def __init__(self, parent, classes):
+    mergeable = True
+
+    def __init__(self, parent, classes, fields=None):
+        if fields is not None:
+            parent.require(fields)
         if isinstance(classes, Callable):
             self.classify = classes
             self.data = Counter()
@@ -127,10 +182,19 @@ class Classify(Op):
     def _classify(self, x):
         return (name for name, pred in self.classes if pred(x))
 
-    def _iter(self, it):
+    def _partial(self, it):
         for x in it:
             for name in self.classify(x):
                 self.data[name] += 1
+        return self.data
+
+    def _combine(self, partials):
+        for data in partials:
+            self.data.update(data)
+        yield dict(self.data)
+
+    def _iter(self, it):
+        self._partial(it)
         yield dict(self.data)
 
 class Map(Op):
@@ -138,11 +202,23 @@ class Map(Op):
     Adds a new function, *op*, to a chain. Note that *op* must be either
     a generator function or it must return an iterator that is passed to
     the next operator in the chain.
+
+    If *combine* is given, the operation is mergeable in :func:`run_sharded`:
+    *combine* is called with a list of lists, items produced by *op* in each
+    shard, and it must return an iterator that is passed to the next operator.
     """
-    def __init__(self, parent, op):
+    def __init__(self, parent, op, combine=None):
         self.op = op
+        self.combine = combine
+        self.mergeable = combine is not None
         super(Map, self).__init__(parent)
 
+    def _partial(self, it):
+        return list(self.op(it))
+
+    def _combine(self, partials):
+        return self.combine(partials)
+
     def _iter(self, it):
         return self.op(it)
 
@@ -222,6 +298,14 @@ class List(Op):
     This operation is often used before :class:`Show` to aggregate data for
     a widget.
     """
+    mergeable = True
+
+    def _partial(self, it):
+        return list(it)
+
+    def _combine(self, partials):
+        yield list(chain_iter.from_iterable(partials))
+
     def _iter(self, it):
         yield list(it)
 
@@ -240,6 +324,51 @@ def randid():
 def register_op(name, op):
     OPS[name] = op
 
+def run_sharded(source, num_shards, batch_size=pipeline.BATCH_SIZE):
+    """
+    Runs all chains over *source* in *num_shards* worker processes, as
+    described in `Sharded Scans`_. Raises :class:`ValueError` if a chain
+    doesn't contain a mergeable operation.
+    """
+    chains = []
+    for chain_id, ops in Profiles._ops.iteritems():
+        for i, op in enumerate(ops):
+            if op.mergeable:
+                chains.append((chain_id, ops[:i], op, ops[i + 1:]))
+                break
+        else:
+            raise ValueError("Chain %s can not be sharded: It needs a "
+                             "mergeable operation" % chain_id)
+
+    def shard(it):
+        def prefix(chain_id, ops, op):
+            def run(it):
+                for prev in ops:
+                    it = prev._iter(it)
+                partials[chain_id] = op._partial(it)
+                return []
+            return run
+        partials = {}
+        if not pipeline.run(it, [prefix(chain_id, ops, op)\
+                                 for chain_id, ops, op, rest in chains]):
+            raise Exception("Shard failed")
+        yield partials
+
+    results = pipeline.run_sharded(source,
+                                   shard,
+                                   num_shards,
+                                   lambda profile: profile.uid,
+                                   batch_size)
+    if results is None:
+        return False
+    for chain_id, ops, op, rest in chains:
+        it = op._combine([partials[chain_id] for [partials] in results])
+        for later in rest:
+            it = later._iter(it)
+        for x in it:
+            pass
+    return True
+
 OPS = {'classify': Classify,
        'map': Map,
        'log': Log,
@@ -1,8 +1,95 @@
-from bencode import BenCompressed, bencode, encoder_alias
+from bencode import bencode, encoder_alias, skip, decode_dict,\
+                    compress, decompress
 from lazylist import BenLazyList
-from itertools import chain, imap, dropwhile
+from columnar import encode_events, decode_events, decode_column
+import zdict as zdicts
+import weakref
+import bloom
+from itertools import chain, imap, izip, repeat,\
+                       dropwhile, takewhile
+from collections import deque
+from heapq import heappush, heappop
+from datetime import datetime, timedelta
+from fields import F_TSTAMP
 
 COMPRESS_CHUNK_SIZE = 65536
+MIN_CHUNK_SIZE = 4096
+# compact() aims at compressed chunks of this size
+TARGET_COMPRESSED_SIZE = 16384
+# compact() doesn't touch this many newest chunks
+COMPACT_KEEP_NEWEST = 2
+# number of chunks (de)compressed ahead in a thread pool
+READ_AHEAD = 4
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+def make_chunk(data, header, codec=None, zdict=None):
+    # A tail chunk with a header: 'k<length>:<header><compressed data>'
+    # where header is a bencoded dictionary with the following keys:
+    #
+    # n: number of items
+    # sz: size of the uncompressed items
+    # first, last: the newest and the oldest item, bencoded
+    # lo, hi: min and max key of items, if an index key is used
+    # fmt: 'events' if the data is encoded with columnar.encode_events(),
+    #      otherwise the data is an encoded list of items
+    # codec: name of a codec in bencode.codecs, if not snappy
+    # zd: id of a zdict.Dictionary used to compress the data with zlib
+    # bf, bi: a bloom filter of values of the fields (indices) bi
+    # ret: retention policy of the list, see ChunkedList. A chunk with
+    #      this key is empty (n=0) and stored as the oldest chunk.
+    #
+    if zdict:
+        header['zd'] = zdict.id
+        compressed = zdict.compress(data)
+    elif codec:
+        header['codec'] = codec
+        compressed = compress(data, codec=codec)
+    else:
+        compressed = compress(data, use_snappy=True)
+    payload = bencode(header) + compressed
+    return 'k%d:%s' % (len(payload), payload)
+
+def chunk_header(chunk):
+    # Returns the header of a chunk made by make_chunk() and the offset
+    # of its compressed data.
+    return decode_dict(chunk, chunk.index(':') + 1)
+
+def chunk_data(chunk):
+    # Returns the header and the items of a tail chunk as an encoded
+    # list. Chunks without a header are compressed lazylists.
+    if chunk[0] == 'k':
+        header, offset = chunk_header(chunk)
+        if 'zd' in header:
+            data = zdicts.get(header['zd']).decompress(chunk[offset:])
+        else:
+            data = decompress(chunk[offset:], header.get('codec'))
+        return header, data
+    else:
+        data = decompress(chunk[chunk.index(':') + 1:])
+        if data[0] == 'y':
+            data = data[data.index(':') + 1:]
+        return {}, data
+
+def bloom_key(field, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '%d:%s' % (field, bencode(value))
+
+def decompress_chunk(chunk):
+    # chunk_data() for compressed chunks, None for plain lazylists
+    if chunk[0] in 'kz':
+        return chunk_data(chunk)
+
+def read_ahead(pool, func, items, depth):
+    # Maps func over items in pool, in order, computing at most depth
+    # results ahead of the consumer.
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) > depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 class ChunkedList(BenLazyList):
     # ChunkedList structure
@@ -16,73 +103,709 @@ class ChunkedList(BenLazyList):
     # Both head and tail are optional initially.
     # Proper ChunkedLists always have a head.
     #
-    def __init__(self, data='le', chunk_size=COMPRESS_CHUNK_SIZE, **kwargs):
+    # In memory, the head is a bytearray of encoded items, oldest first,
+    # so that push() only appends to it. _head_offsets contains the
+    # offset of each item.
+    #
+    # Tail chunks are either 'z' (BenCompressed) chunks or 'k' chunks that
+    # have an uncompressed header, see make_chunk(). If index_key is given,
+    # the header includes the range of index_key(item) in the chunk,
+    # which allows range() to skip chunks. If columnar is True, chunks of
+    # events are stored in a columnar format. They decode to lists like
+    # other items. If bloom_fields, a
+    # list of field indices, is given, the header includes a bloom filter
+    # of values of the fields, which allows may_contain() and find() to
+    # skip chunks.
+    #
+    # A retention policy drops the oldest tail chunks, when push() makes
+    # a new chunk and on encode() and changed(), if their newest item is
+    # older than max_age seconds (by the ISO 8601 timestamp in
+    # age_field), or if the list would still have at least max_items
+    # items or max_bytes encoded bytes without them. The policy is stored
+    # in the encoded list and used if no limits are given to the
+    # constructor.
+    #
+    # New chunks are compressed with snappy, or with codec, a name
+    # registered with bencode.register_codec(), or with zlib and zdict,
+    # a zdict.Dictionary.
+    #
+    # If pool, e.g. a multiprocessing.pool.ThreadPool, is given, full
+    # scans decompress up to read_ahead chunks ahead of the iterator in
+    # the pool, and push() compresses new chunks in the pool with at most
+    # read_ahead chunks pending. zlib and snappy release the GIL while
+    # they (de)compress. Pass functools.partial(ChunkedList, pool=pool)
+    # as lazylist_obj to a decoder to use a pool for decoded lists.
+    #
+    def __init__(self,
+                 data='le',
+                 chunk_size=COMPRESS_CHUNK_SIZE,
+                 index_key=None,
+                 columnar=False,
+                 codec=None,
+                 zdict=None,
+                 pool=None,
+                 read_ahead=READ_AHEAD,
+                 bloom_fields=None,
+                 max_age=None,
+                 max_items=None,
+                 max_bytes=None,
+                 age_field=F_TSTAMP,
+                 **kwargs):
         super(ChunkedList, self).__init__(data=data, **kwargs)
         self._chunk_size = min(chunk_size, COMPRESS_CHUNK_SIZE)
+        self._index_key = index_key
+        self._columnar = columnar
+        self._codec = codec
+        self._zdict = zdict
+        self._pool = pool
+        self._read_ahead = read_ahead
+        self._bloom_fields = bloom_fields
+        # chunks being compressed in the pool, oldest first
+        self._pending = deque()
+        self._head = bytearray()
+        self._head_offsets = []
         if data[1] == 'y':
             head, offset = self._decode(data, 2)
-            self._head = [head[1:-1]]
-            self._head_size = len(head) - 2
-            tail = data[offset:-1]
+            items = []
+            item_offset = 1
+            while item_offset < len(head) - 1:
+                end = skip(head, item_offset)
+                items.append(head[item_offset:end])
+                item_offset = end
+            self._append_head(reversed(items))
         else:
-            self._head = []
-            self._head_size = 0
-            tail = data[1:-1]
+            offset = 1
+        # tail is stored as a list of chunks, oldest first
         self._tail = []
-        if tail:
-            self._tail.append(tail)
+        end = len(data) - 1
+        tail_offset = offset
+        while offset < end:
+            chunk_end = skip(data, offset)
+            self._tail.append(data[offset:chunk_end])
+            offset = chunk_end
+        self._tail.reverse()
+        retention = None
+        if self._tail and self._tail[0][0] == 'k':
+            header = chunk_header(self._tail[0])[0]
+            if 'ret' in header:
+                retention = header['ret']
+                end -= len(self._tail.pop(0))
+        # encoding of the oldest _encoded_tail[0] chunks of the tail, or
+        # None until the tail, data[_tail_bounds], is first encoded
+        self._encoded_tail = (len(self._tail), None)
+        self._tail_bounds = (tail_offset, end)
+        # number of items in the oldest _tail_len[0] chunks
+        self._tail_len = None
+        self._changed = False
+        limits = (('age', max_age), ('items', max_items),
+                  ('bytes', max_bytes))
+        if any(limit is not None for name, limit in limits):
+            policy = dict((name, limit) for name, limit in limits
+                          if limit is not None)
+            policy['field'] = age_field
+            if policy != retention:
+                self._changed = True
+            retention = policy
+        self._retention = retention
+        if retention:
+            self._retention_chunk = make_chunk('le',
+                                               {'n': 0, 'ret': retention},
+                                               codec='zlib')
+        else:
+            self._retention_chunk = ''
+
+    def changed(self):
+        if not self._changed:
+            # expired chunks change an idle list too
+            self._enforce_retention()
+        return self._changed
 
     def encode(self):
-        self._tail.append(bencode(self._encode_head()))
-        self._tail.append('l')
-        self._tail.reverse()
-        self._tail.append('e')
-        ret = ''.join(self._tail)
-        self._head = None
-        self._tail = None
-        return ret
+        self._sync()
+        self._enforce_retention()
+        if not self._changed:
+            # pass the original encoding through as is
+            return self._data
+        head = self._encode_head()
+        return 'ly%d:%s%s%se' % (len(head), head, self._encode_tail(),
+                                 self._retention_chunk)
+
+    def _enforce_retention(self):
+        # drops the oldest chunks of the tail, see the class comment.
+        # Chunks still being compressed are not included.
+        if not self._retention:
+            return
+        num = 0
+        max_age = self._retention.get('age')
+        if max_age is not None:
+            field = self._retention['field']
+            cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+            cutoff = cutoff.strftime(TIMESTAMP_FORMAT)
+            def expired(chunk):
+                return self._boundary_item(chunk, 'first')[field] < cutoff
+            while num < len(self._tail) and expired(self._tail[num]):
+                num += 1
+        max_items = self._retention.get('items')
+        if max_items is not None:
+            excess = len(self._head_offsets) + self._tail_count() - max_items
+            for i, chunk in enumerate(self._tail):
+                excess -= self._chunk_len(chunk)
+                if excess < 0:
+                    break
+                num = max(num, i + 1)
+        max_bytes = self._retention.get('bytes')
+        if max_bytes is not None:
+            excess = len(self._head) + sum(imap(len, self._tail)) - max_bytes
+            for i, chunk in enumerate(self._tail):
+                excess -= len(chunk)
+                if excess < 0:
+                    break
+                num = max(num, i + 1)
+        if num:
+            self._set_tail(self._tail[num:])
+
+    def _encode_tail(self):
+        # chunks are only added to the end of the tail after the previous
+        # encoding, unless the tail is rewritten
+        num, encoded = self._encoded_tail
+        if encoded is None:
+            start, end = self._tail_bounds
+            encoded = self._data[start:end]
+            self._encoded_tail = (num, encoded)
+        if num < len(self._tail):
+            new = self._tail[num:]
+            new.reverse()
+            new.append(encoded)
+            self._encoded_tail = (len(self._tail), ''.join(new))
+        return self._encoded_tail[1]
+
+    def _set_tail(self, tail):
+        self._tail = tail
+        self._encoded_tail = (0, '')
+        self._tail_len = None
+        self._cached.clear()
+        self._cached_bytes = 0
+        self._changed = True
+
+    def __reduce__(self):
+        return (self.__class__, (self.encode(), self._chunk_size))
 
     def push(self, items):
-        for item in reversed(map(bencode, items)):
-            self._head.append(item)
-            self._head_size += len(item)
-            if self._head_size > self._chunk_size:
-                chunk = bencode(BenCompressed(self._encode_head(),
-                                              use_snappy=True))
-                self._tail.append(chunk)
-                self._head_size = 0
-                self._head = []
+        items = map(bencode, items)
+        if items:
+            self._changed = True
+        # items are given newest first
+        for i in range(len(items) - 1, -1, -1):
+            self._append_head((items[i],))
+            if len(self._head) > self._chunk_size:
+                self._flush_head()
+                self._enforce_retention()
+
+    def _flush_head(self):
+        # moves the head to a new tail chunk
+        if self._pool:
+            args = self._chunk_args(self._encode_head())
+            self._pending.append(self._pool.apply_async(make_chunk, args))
+            if len(self._pending) > self._read_ahead:
+                self._tail.append(self._pending.popleft().get())
+        else:
+            self._tail.append(self._make_chunk(self._encode_head()))
+        del self._head[:]
+        self._head_offsets = []
+
+    def _append_head(self, items):
+        for item in items:
+            self._head_offsets.append(len(self._head))
+            self._head.extend(item)
 
     def _encode_head(self):
-        self._head.append('l')
-        self._head.reverse()
-        self._head.append('e')
-        return BenLazyList(''.join(self._head))
+        # the head as an encoded list, newest first
+        head = str(self._head)
+        ends = self._head_offsets[1:] + [len(head)]
+        return 'l%se' % ''.join([head[start:end] for start, end in
+                                 reversed(zip(self._head_offsets, ends))])
+
+    def _head_iter(self, start=0):
+        head = str(self._head)
+        offsets = self._head_offsets[:len(self._head_offsets) - start]
+        for offset in reversed(offsets):
+            yield self._decode(head, offset)[0]
+
+    def _sync(self):
+        # wait for chunks being compressed in the pool
+        while self._pending:
+            self._tail.append(self._pending.popleft().get())
+
+    def _make_chunk(self, data):
+        return make_chunk(*self._chunk_args(data))
+
+    def _chunk_args(self, data):
+        # make_chunk() arguments for data, an encoded list of items
+        header = {'n': 0, 'sz': len(data)}
+        items = []
+        offset = 1
+        size = len(data) - 1
+        while offset < size:
+            item, end = self._decode(data, offset)
+            if not header['n']:
+                header['first'] = data[offset:end]
+            header['last'] = data[offset:end]
+            header['n'] += 1
+            items.append(item)
+            offset = end
+        if self._index_key and items:
+            keys = map(self._index_key, items)
+            header['lo'] = min(keys)
+            header['hi'] = max(keys)
+        if self._bloom_fields and items:
+            try:
+                header['bf'] = bloom.make(bloom_key(field, item[field])
+                                          for item in items
+                                          for field in self._bloom_fields)
+                header['bi'] = list(self._bloom_fields)
+            except (IndexError, KeyError, TypeError):
+                # items without the fields
+                pass
+        if self._columnar:
+            columns = encode_events(items)
+            if columns is not None:
+                header['fmt'] = 'events'
+                data = bencode(columns)
+        return data, header, self._codec, self._zdict
+
+    def _encoded_items(self, chunk):
+        # encoded items of a chunk, newest first
+        header, data = chunk_data(chunk)
+        if header.get('fmt') == 'events':
+            return map(bencode, decode_events(self._decode(data, 0)[0]))
+        items = []
+        offset = 1
+        size = len(data) - 1
+        while offset < size:
+            end = self._decode(data, offset)[1]
+            items.append(data[offset:end])
+            offset = end
+        return items
+
+    def _items(self, b, offset=0, size=None, start=0):
+        # decodes consecutive items in b after the first start items
+        if size is None:
+            size = len(b)
+        while offset < size and start:
+            offset = skip(b, offset)
+            start -= 1
+        while offset < size:
+            item, offset = self._decode(b, offset)
+            yield item
+
+    def _boundary_item(self, chunk, name):
+        # the first (newest) or the last (oldest) item of a chunk, from
+        # its header if possible
+        if chunk[0] == 'k':
+            header = chunk_header(chunk)[0]
+            if name in header:
+                return self._decode(header[name], 0)[0]
+        items = self._chunk_iter(chunk)
+        if name == 'first':
+            return items.next()
+        for item in items:
+            pass
+        return item
+
+    def _trim_chunk(self, chunk, pred):
+        # drop the oldest items that fail pred
+        if pred(self._boundary_item(chunk, 'last')):
+            return chunk
+        kept = takewhile(pred, self._chunk_iter(chunk))
+        return self._make_chunk(bencode(list(kept)))
+
+    def _chunk_iter(self, chunk, decompressed=None, start=0):
+        if chunk[0] in 'kz':
+            header, data = decompressed or chunk_data(chunk)
+            if header.get('fmt') == 'events':
+                events = decode_events(self._decode(data, 0)[0], list)
+                return iter(events[start:])
+            return self._items(data, 1, len(data) - 1, start)
+        else:
+            return self.iter(chunk, start)
+
+    def _chunk_len(self, chunk, decompressed=None):
+        if chunk[0] == 'k':
+            return chunk_header(chunk)[0]['n']
+        elif chunk[0] == 'z':
+            if not decompressed:
+                decompressed = chunk_data(chunk)
+                self._cache(chunk, decompressed, len(decompressed[1]))
+            data = decompressed[1]
+            n = 0
+            offset = 1
+            while offset < len(data) - 1:
+                offset = skip(data, offset)
+                n += 1
+            return n
+        else:
+            return self._count(chunk)
+
+    def column(self, field):
+        """
+        Iterates over the field *field* (an index, e.g.
+        :data:`bitdeli.fields.F_TSTAMP`) of items, newest first. Other fields
+        of columnar chunks are not decoded.
+        """
+        def chunk_column(chunk):
+            if chunk[0] == 'k':
+                header, data = chunk_data(chunk)
+                if header.get('fmt') == 'events':
+                    return decode_column(self._decode(data, 0)[0], field)
+                items = self._items(data, 1, len(data) - 1)
+            else:
+                items = self._chunk_iter(chunk)
+            return (item[field] for item in items)
+        self._sync()
+        return chain((item[field] for item in self._head_iter()),
+                     chain.from_iterable(imap(chunk_column,
+                                              reversed(self._tail))))
+
+    def _tail_chunks(self, start=0):
+        self._new_iter = None
+        self._sync()
+        chunks = list(reversed(self._tail))
+        # skip chunks by their header without decompressing them
+        num_skipped = 0
+        for chunk in chunks:
+            if not start or chunk[0] != 'k':
+                break
+            n = self._chunk_len(chunk)
+            if n > start:
+                break
+            start -= n
+            num_skipped += 1
+        chunks = chunks[num_skipped:]
+        def decompress(chunk):
+            # chunks counted by len() are decompressed already
+            return self._take_cached(chunk) or decompress_chunk(chunk)
+        if self._pool:
+            decompressed = read_ahead(self._pool, decompress, chunks,
+                                      self._read_ahead)
+        elif self._cached:
+            decompressed = imap(self._take_cached, chunks)
+        else:
+            decompressed = repeat(None)
+        for chunk, data in izip(chunks, decompressed):
+            if start:
+                n = self._chunk_len(chunk, data)
+                if n <= start:
+                    start -= n
+                    continue
+            yield self._chunk_iter(chunk, data, start)
+            start = 0
 
     def __iter__(self):
-        return chain((self._decode(x, 0)[0] for x in reversed(self._head)),
-                     chain.from_iterable(imap(self.iter, reversed(self._tail))))
+        tail = self._tail_chunks()
+        self._new_iter = weakref.ref(tail)
+        return chain(self._head_iter(), chain.from_iterable(tail))
+
+    def _chunk_reversed(self, chunk, decompressed=None):
+        if chunk[0] in 'kz':
+            header, data = decompressed or chunk_data(chunk)
+            if header.get('fmt') == 'events':
+                events = decode_events(self._decode(data, 0)[0], list)
+                return reversed(events)
+            offsets = self._item_offsets(data, 1, len(data) - 1)
+            return (self._decode(data, offset)[0]
+                    for offset in reversed(offsets))
+        else:
+            return self.iter_reversed(chunk)
+
+    def __reversed__(self):
+        # oldest chunks are at the start of the tail
+        def tail_chunks():
+            self._sync()
+            chunks = list(self._tail)
+            if self._pool:
+                decompressed = read_ahead(self._pool, decompress_chunk,
+                                          chunks, self._read_ahead)
+            else:
+                decompressed = repeat(None)
+            for chunk, data in izip(chunks, decompressed):
+                yield self._chunk_reversed(chunk, data)
+        def head_items():
+            head = str(self._head)
+            for offset in self._head_offsets:
+                yield self._decode(head, offset)[0]
+        return chain(chain.from_iterable(tail_chunks()), head_items())
+
+    def skip(self, n):
+        """
+        Iterates over items after the first *n* items. Tail chunks that
+        contain only skipped items are not decompressed.
+        """
+        num_head = len(self._head_offsets)
+        if n < num_head:
+            return chain(self._head_iter(n),
+                         chain.from_iterable(self._tail_chunks()))
+        return chain.from_iterable(self._tail_chunks(n - num_head))
+
+    def __len__(self):
+        self._sync()
+        return len(self._head_offsets) + self._tail_count()
+
+    def _tail_count(self):
+        num, count = self._tail_len or (0, 0)
+        if num < len(self._tail):
+            count += sum(imap(self._chunk_len, self._tail[num:]))
+            self._tail_len = (len(self._tail), count)
+        return count
+
+    def adaptive_chunk_size(self):
+        """
+        Returns a chunk size that makes compressed chunks about
+        TARGET_COMPRESSED_SIZE bytes, based on the compression ratio of
+        the current chunks.
+        """
+        self._sync()
+        compressed = uncompressed = 0
+        for chunk in self._tail:
+            if chunk[0] == 'k':
+                size = chunk_header(chunk)[0].get('sz')
+                if size:
+                    compressed += len(chunk)
+                    uncompressed += size
+        if not compressed:
+            return self._chunk_size
+        size = TARGET_COMPRESSED_SIZE * uncompressed / compressed
+        return max(MIN_CHUNK_SIZE, min(size, COMPRESS_CHUNK_SIZE))
+
+    def compact(self, chunk_size=None):
+        """
+        Merges consecutive tail chunks smaller than half of *chunk_size*
+        and splits chunks larger than twice *chunk_size*. By default,
+        :meth:`adaptive_chunk_size` is used, and it becomes the chunk size
+        of this list.
+
+        The newest COMPACT_KEEP_NEWEST chunks are left as they are: reads
+        of the latest items usually stop there, and they stay small and
+        cheap to decompress.
+        """
+        self._sync()
+        if chunk_size is None:
+            chunk_size = self._chunk_size = self.adaptive_chunk_size()
+        def size_of(chunk):
+            if chunk[0] == 'k':
+                return chunk_header(chunk)[0].get('sz')
+        def make(group):
+            # group is oldest first
+            group.reverse()
+            tail.append(self._make_chunk('l%se' % ''.join(group)))
+        def flush(pending):
+            if len(pending) == 1 and size_of(pending[0]) <= chunk_size * 2:
+                # nothing to merge with
+                tail.extend(pending)
+            elif pending:
+                items = []
+                for chunk in reversed(pending):
+                    items.extend(self._encoded_items(chunk))
+                group = []
+                size = 0
+                for item in reversed(items):
+                    group.append(item)
+                    size += len(item)
+                    if size > chunk_size:
+                        make(group)
+                        group = []
+                        size = 0
+                if group:
+                    make(group)
+        num_kept = max(0, len(self._tail) - COMPACT_KEEP_NEWEST)
+        tail = []
+        pending = []
+        for chunk in self._tail[:num_kept]:
+            size = size_of(chunk)
+            if size and chunk_size / 2 <= size <= chunk_size * 2:
+                flush(pending)
+                pending = []
+                tail.append(chunk)
+            else:
+                pending.append(chunk)
+        flush(pending)
+        tail.extend(self._tail[num_kept:])
+        if tail != self._tail:
+            self._set_tail(tail)
+
+    def range(self, lo, hi, key=None):
+        """
+        Iterates over items whose key, *lo <= key(item) <= hi*, newest
+        first. By default, the index key of this list is used. Tail chunks
+        whose header shows that they are out of range are not decompressed.
+        """
+        self._sync()
+        key = key or self._index_key
+        if not key:
+            raise ValueError("No key given for range()")
+        def chunks():
+            for chunk in reversed(self._tail):
+                if chunk[0] == 'k' and key == self._index_key:
+                    header = chunk_header(chunk)[0]
+                    if 'lo' in header and\
+                       (header['hi'] < lo or header['lo'] > hi):
+                        continue
+                yield self._chunk_iter(chunk)
+        items = chain(self._head_iter(), chain.from_iterable(chunks()))
+        return (item for item in items if lo <= key(item) <= hi)
+
+    def _chunk_may_contain(self, chunk, value, field):
+        if chunk[0] == 'k':
+            header = chunk_header(chunk)[0]
+            if 'bf' in header and field in header['bi']:
+                return bloom.contains(header['bf'], bloom_key(field, value))
+        return True
+
+    def may_contain(self, value, field):
+        """
+        Returns *False* if no item has *value* in the field (index) *field*,
+        e.g. :data:`bitdeli.fields.F_OBJECT`. Only the head and the bloom
+        filters of tail chunks are read, so *True* may be a false positive.
+        Chunks without a filter of *field* may always contain *value*.
+        """
+        self._sync()
+        if any(item[field] == value for item in self._head_iter()):
+            return True
+        return any(self._chunk_may_contain(chunk, value, field)
+                   for chunk in self._tail)
+
+    def find(self, value, field):
+        """
+        Iterates over items that have *value* in the field (index) *field*,
+        newest first. Tail chunks whose bloom filter shows that they don't
+        contain *value* are not decompressed.
+        """
+        self._sync()
+        def chunks():
+            for chunk in reversed(self._tail):
+                if self._chunk_may_contain(chunk, value, field):
+                    yield self._chunk_iter(chunk)
+        items = chain(self._head_iter(), chain.from_iterable(chunks()))
+        return (item for item in items if item[field] == value)
+
+    def _key_range(self, chunk, key):
+        # (min, max) of key(item) in chunk, None if the chunk is empty
+        if chunk[0] == 'k':
+            header = chunk_header(chunk)[0]
+            if not header['n']:
+                return None
+            if key == self._index_key and 'lo' in header:
+                return header['lo'], header['hi']
+        try:
+            return (key(self._boundary_item(chunk, 'last')),
+                    key(self._boundary_item(chunk, 'first')))
+        except StopIteration:
+            return None
+
+    def _merge_segments(self, key):
+        # (min key, max key, segment) of the tail chunks and the head,
+        # oldest first
+        self._sync()
+        for chunk in self._tail:
+            key_range = self._key_range(chunk, key)
+            if key_range:
+                yield key_range + (chunk,)
+        head = str(self._head)
+        items = deque(self._decode(head, offset)[0]
+                      for offset in self._head_offsets)
+        if items:
+            yield key(items[0]), key(items[-1]), items
+
+    @classmethod
+    def merge(cls, *lists, **kwargs):
+        """
+        Merges *lists* to a new ChunkedList. Each list must be ordered by
+        *key*, the index key of the first list by default, so that the
+        newest item has the largest key. Tail chunks whose range of keys
+        doesn't overlap with the other lists are moved to the new list
+        without decompressing them, so only overlapping items are decoded.
+        Other keyword arguments are passed to the constructor of the new
+        list.
+        """
+        key = kwargs.pop('key', None) or (lists and lists[0]._index_key)
+        if not key:
+            raise ValueError("No key given for merge()")
+        merged = cls(**kwargs)
+        sources = [lst._merge_segments(key) for lst in lists]
+        # heap of (min key, list index, max key, segment) where segment is
+        # a tail chunk or a deque of items, oldest first
+        heap = []
+        def next_segment(i):
+            for segment in sources[i]:
+                heappush(heap, segment[:1] + (i,) + segment[1:])
+                break
+        for i in range(len(lists)):
+            next_segment(i)
+        while heap:
+            lo, i, hi, segment = heappop(heap)
+            bound = heap[0][0] if heap else None
+            if isinstance(segment, deque):
+                items = []
+                while segment and (bound is None or key(segment[0]) <= bound):
+                    items.append(segment.popleft())
+                items.reverse()
+                merged.push(items)
+                if segment:
+                    heappush(heap, (key(segment[0]), i, hi, segment))
+                else:
+                    next_segment(i)
+            elif bound is None or hi <= bound:
+                if merged._head_offsets:
+                    merged._flush_head()
+                # chunks being compressed in a pool are older
+                merged._sync()
+                merged._tail.append(segment)
+                merged._changed = True
+                next_segment(i)
+            else:
+                items = deque(lists[i]._chunk_reversed(segment))
+                heappush(heap, (lo, i, hi, items))
+        return merged
 
     def __nonzero__(self):
-        return 1 if self._tail or self._head else 0
+        return 1 if self._tail or self._pending or self._head else 0
 
-    def drop_chunks(self, pred):
+    def drop_chunks(self, pred, precise=False):
         def tail_predicate(chunk):
             # Check the first (newest) item of each chunk - drop the whole
             # chunk if the predicate fails. Note that since we check only
             # the first item, the chunk may still contain entries for which
             # the predicate would fail, so drop_chunks IS NOT guaranteed to
-            # get rid of all the items in the tail which fail the predicate.
+            # get rid of all the items in the tail which fail the predicate,
+            # unless precise is True.
             #
             # The assumption is that the predicate will change over time and
             # eventually fail the first item, thus drop the chunk.
-            return not (chunk and pred(self.iter(chunk).next()))
-        def head_predicate(item):
-            return not (item and pred(self._decode(item, 0)[0]))
-        self._tail = list(dropwhile(tail_predicate, self._tail))
+            #
+            # Chunks with a header store their first item, so they are
+            # dropped without decompressing them.
+            return not (chunk and pred(self._boundary_item(chunk, 'first')))
+        self._sync()
+        num = len(self._head_offsets)
+        tail = list(dropwhile(tail_predicate, self._tail))
+        if precise and tail:
+            # only the oldest remaining chunk may contain failing items
+            tail[0] = self._trim_chunk(tail[0], pred)
+        if tail != self._tail:
+            self._set_tail(tail)
         if not self._tail:
             # head is cleaned only if there is nothing left in the tail.
-            self._head = list(dropwhile(head_predicate, self._head))
+            head = str(self._head)
+            for i, offset in enumerate(self._head_offsets):
+                if pred(self._decode(head, offset)[0]):
+                    del self._head[:offset]
+                    self._head_offsets = [x - offset for x in
+                                          self._head_offsets[i:]]
+                    break
+            else:
+                del self._head[:]
+                self._head_offsets = []
+        if len(self._head_offsets) != num:
+            self._changed = True
 
 encoder_alias(ChunkedList, BenLazyList)
 
@@ -125,6 +848,13 @@ if __name__ == '__main__':
         print 'iter (%d items) took %dms' % (c, (time.time() - t1) * 1000)
         buf = None
         f.close()
+        items = list(chu)
+        t1 = time.time()
+        chu = ChunkedList()
+        for item in items:
+            chu.push((item,))
+        print 'push (%d items) took %dms' % (len(items),
+                                              (time.time() - t1) * 1000)
         t1 = time.time()
         enc = bencode(chu)
         print 'sze', len(bencode(chu))
@@ -147,4 +877,28 @@ if __name__ == '__main__':
         print list(c)
         print list(bdecode(bencode(c)))
 
+    def rangetest():
+        c = ChunkedList(chunk_size=7, index_key=lambda x: x)
+        for i in ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i'):
+            c.push((i,))
+        d = ChunkedList(c.encode(), index_key=lambda x: x)
+        print list(d.range('c', 'e'))
+
+    def mergetest():
+        from multiprocessing.pool import ThreadPool
+        def make(prefix, num):
+            c = ChunkedList(chunk_size=20, index_key=lambda x: x)
+            for i in range(num):
+                c.push(('%s%03d' % (prefix, i),))
+            return ChunkedList(c.encode(), index_key=lambda x: x)
+        a = make('a', 42)
+        b = make('b', 40)
+        expected = sorted(list(a) + list(b), reverse=True)
+        for pool in (None, ThreadPool(2)):
+            merged = ChunkedList.merge(a, b, chunk_size=20, pool=pool)
+            print list(merged) == expected,\
+                  list(ChunkedList(merged.encode())) == expected
+
     droptest()
+    rangetest()
+    mergetest()
@@ -0,0 +1,137 @@
+from fields import Event, F_TSTAMP
+from datetime import datetime, timedelta
+from itertools import izip
+
+# Columnar encoding of Event tuples for ChunkedList chunks
+#
+# A chunk of events is encoded as a list [count, column, column, ...] with
+# one column for each field of Event. A column is either
+#
+# ['d', values, indices]: dictionary-encoded, indices are varints
+# ['t', deltas]: ISO 8601 timestamps as microseconds since the epoch,
+#                the first as is and the rest as zigzag-encoded varint
+#                deltas to the previous one.
+#
+# Only lists of events are encoded: the timestamp field of every item must
+# be an ISO 8601 timestamp. Timestamps that don't survive the round trip
+# exactly are dictionary-encoded.
+
+EPOCH = datetime(1970, 1, 1)
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ')
+
+def encode_varints(nums):
+    r = []
+    for n in nums:
+        while n > 0x7f:
+            r.append(chr(0x80 | (n & 0x7f)))
+            n >>= 7
+        r.append(chr(n))
+    return ''.join(r)
+
+def decode_varints(s):
+    n = shift = 0
+    for c in s:
+        c = ord(c)
+        n |= (c & 0x7f) << shift
+        if c & 0x80:
+            shift += 7
+        else:
+            yield n
+            n = shift = 0
+
+def zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+def parse_timestamp(ts):
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            t = datetime.strptime(ts, fmt) - EPOCH
+        except ValueError:
+            continue
+        return (t.days * 86400 + t.seconds) * 1000000 + t.microseconds
+
+def format_timestamp(n):
+    return (EPOCH + timedelta(microseconds=n)).isoformat('T') + 'Z'
+
+def encode_dictionary(column):
+    index = {}
+    values = []
+    indices = []
+    for value in column:
+        i = index.get(value)
+        if i is None:
+            i = index[value] = len(values)
+            values.append(value)
+        indices.append(i)
+    return ['d', values, encode_varints(indices)]
+
+def encode_timestamps(column):
+    prev = 0
+    deltas = []
+    for ts in column:
+        if not isinstance(ts, str):
+            return None
+        n = parse_timestamp(ts)
+        if n is None or format_timestamp(n) != ts:
+            return None
+        deltas.append(zigzag(n - prev))
+        prev = n
+    return ['t', encode_varints(deltas)]
+
+def encode_events(items):
+    """
+    Returns a columnar encoding of *items*, or *None* if they are not
+    events with valid timestamps.
+    """
+    num_fields = len(Event._fields)
+    for item in items:
+        if not isinstance(item, (list, tuple)) or len(item) != num_fields:
+            return None
+    encoded = [len(items)]
+    for i, column in enumerate(izip(*items)):
+        try:
+            if i == F_TSTAMP:
+                enc = encode_timestamps(column)
+                if enc is None:
+                    for ts in column:
+                        if not isinstance(ts, basestring) or\
+                           parse_timestamp(ts) is None:
+                            return None
+                    enc = encode_dictionary(column)
+            else:
+                enc = encode_dictionary(column)
+            encoded.append(enc)
+        except TypeError:
+            # unhashable values
+            return None
+    if len(encoded) == 1:
+        encoded.extend([['d', [], '']] * num_fields)
+    return encoded
+
+def decode_column(encoded, field):
+    """
+    Returns values of the field (index) *field* in the events encoded by
+    :func:`encode_events`, without decoding other fields.
+    """
+    column = encoded[field + 1]
+    if column[0] == 't':
+        n = 0
+        values = []
+        for delta in decode_varints(column[1]):
+            n += unzigzag(delta)
+            values.append(format_timestamp(n))
+        return values
+    else:
+        values = column[1]
+        return [values[i] for i in decode_varints(column[2])]
+
+def decode_events(encoded, factory=Event._make):
+    """
+    Returns events encoded by :func:`encode_events` as :class:`Event`
+    tuples, or as objects made by *factory* from each tuple of fields.
+    """
+    columns = [decode_column(encoded, i) for i in range(len(Event._fields))]
+    return map(factory, izip(*columns))
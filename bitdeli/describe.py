@@ -1,4 +1,4 @@
-from profiles import Op, register_op
+from chain import Op, register_op
 from collections import Counter, Mapping
 from itertools import islice
 
@@ -22,6 +22,8 @@ def default_features(mapping, prefix='', exclude=[], include=[]):
             yield item
 
 class Describe(Op):
+    mergeable = True
+
     def __init__(self,
                  parent,
                  classify,
@@ -29,7 +31,10 @@ class Describe(Op):
                  min_frequency=10,
                  num_top_features=10,
                  num_top_segments=10,
-                 exclude_specific=True):
+                 exclude_specific=True,
+                 fields=None):
+        if fields is not None:
+            parent.require(fields)
         self.classify = classify
         self.features = features
         self.min_frequency = min_frequency
@@ -41,7 +46,7 @@ class Describe(Op):
         self.segment_sizes = Counter()
         super(Describe, self).__init__(parent)
 
-    def _iter(self, it):
+    def _partial(self, it):
         freqs = self.freqs
         for profile in it:
             features = list(self.features(profile))
@@ -52,10 +57,25 @@ class Describe(Op):
                 if not stats:
                     self.segments[segment] = stats = Counter()
                 stats.update(features)
+        return self.stats()
+
+    def _combine(self, partials):
+        for segments, freqs, segment_sizes in partials:
+            self.freqs.update(freqs)
+            self.segment_sizes.update(segment_sizes)
+            for segment, stats in segments.iteritems():
+                self.segments.setdefault(segment, Counter()).update(stats)
+        return self._finish()
+
+    def _finish(self):
         self.freqs = dict(x for x in self.freqs.iteritems()\
                           if x[1] > self.min_frequency)
         return self
 
+    def _iter(self, it):
+        self._partial(it)
+        return self._finish()
+
     def stats(self):
         return self.segments, self.freqs, self.segment_sizes
 
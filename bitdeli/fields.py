@@ -1,5 +1,6 @@
 from collections import namedtuple
-from bencode import BenJson
+from bencode import BenJson, encoder_alias
+from types import TupleType
 from datetime import datetime
 from json import dumps
 
@@ -13,6 +14,8 @@ F_GROUPKEY = 5
 Event = namedtuple('Event',
                    ('uid', 'ip', 'object', 'id', 'timestamp', 'groupkey'))
 
+encoder_alias(Event, TupleType)
+
 def make_event(uid, obj, groupkey):
     tstamp = datetime.utcnow().isoformat('T') + 'Z'
     return (str(uid), '0.0.0.0', obj, '', tstamp, groupkey)
@@ -21,12 +21,21 @@ to decode and decompress the rest of the list.
 Interface
 ---------
 
-Two operations are supported:
+The following operations are supported:
 
 - **Iteration**: :mod:`bitdeli.lazylist` can be treated as an iterator.
   Note that by convention the iterator produces newest items first.
 - **Truth testing**: `if lazylist` returns *True* only if *lazylist* is
   not empty.
+- **Skipping**: `lazylist.skip(n)` iterates over items after the first *n*
+  items without decoding the skipped items.
+- **Reversed iteration**: `reversed(lazylist)` produces the oldest items
+  first.
+- **Counting and slicing**: `len(lazylist)` counts items without decoding
+  them and `lazylist[i]` and `lazylist[i:j]` skip to the requested items.
+  When `list(lazylist)` asks for the length before iterating, nested
+  compressed lists that have to be decompressed for counting are kept for
+  the iteration, so they are decompressed only once.
 
 To benefit from the optimizations, use constructs that avoid
 consuming all items from the iterator, such as
@@ -39,6 +48,13 @@ and `itertools.dropwhile
 """
 
 import bencode
+import weakref
+from itertools import islice
+
+# encoded values that may decode to nested lazy lists
+LAZY_PREFIXES = 'yzk'
+# max size of nested lists decoded by len() and kept for an iterator
+MAX_CACHED_BYTES = 16 * 1024 * 1024
 
 class BenLazyList(object):
     def __init__(self, data='le', decode=None):
@@ -46,28 +62,154 @@ class BenLazyList(object):
             return bencode.decode_func[buf[offset]](buf, offset)
         self._data = data
         self._decode = decode if decode else default_decode
+        self._len = None
+        self._cached = {}
+        self._cached_bytes = 0
+        self._new_iter = None
 
     def encode(self):
         return self._data
 
     def __iter__(self):
-        return self.iter(self._data)
+        it = self.iter(self._data)
+        self._new_iter = weakref.ref(it)
+        return it
 
     def __nonzero__(self):
         return self._data and self._data != 'le'
 
-    def iter(self, b):
+    def __reduce__(self):
+        # the decode function can't be pickled: unpickled lists use
+        # the default decoder
+        return (self.__class__, (self._data,))
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self._count(self._data)
+        return self._len
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.start or 0, key.stop, key.step or 1
+            if start < 0 or step < 0 or (stop is not None and stop < 0):
+                start, stop, step = key.indices(len(self))
+                if step < 0:
+                    return list(self)[key]
+            if stop is not None:
+                stop = max(0, stop - start)
+            return list(islice(self.skip(start), 0, stop, step))
+        if key < 0:
+            key += len(self)
+        if key >= 0:
+            for item in self.skip(key):
+                return item
+        raise IndexError("lazylist index out of range")
+
+    def skip(self, n):
+        """
+        Iterates over items after the first *n* items. The skipped items
+        are not decoded, except for nested lazy lists.
+        """
+        return self.iter(self._data, n)
+
+    def _bounds(self, b):
         if b and b[0] == 'l':
-            offset = 1
-            size = len(b) - 2
+            return 1, len(b) - 2
         else:
-            offset = 0
-            size = len(b)
+            return 0, len(b)
+
+    def _cache(self, key, value, size):
+        # keeps a value decoded by len() for an iterator that hasn't
+        # started yet, i.e. when list() asks for a length hint
+        new_iter = self._new_iter and self._new_iter()
+        if new_iter is not None and\
+           self._cached_bytes + size <= MAX_CACHED_BYTES:
+            self._cached[key] = value, size
+            self._cached_bytes += size
+
+    def _take_cached(self, key):
+        value, size = self._cached.pop(key, (None, 0))
+        self._cached_bytes -= size
+        return value
+
+    def _count(self, b):
+        # number of items in b, as produced by iter(b)
+        offset, size = self._bounds(b)
+        n = 0
         while offset < size:
-            item, offset = self._decode(b, offset)
+            if b[offset] in LAZY_PREFIXES:
+                start = offset
+                item, offset = self._decode(b, offset)
+                if isinstance(item, BenLazyList):
+                    if b is self._data:
+                        self._cache(start, (item, offset), len(item._data))
+                    n += len(item)
+                    continue
+            else:
+                offset = bencode.skip(b, offset)
+            n += 1
+        return n
+
+    def iter(self, b, start=0):
+        # Nested plain lazy lists are flattened using an explicit stack
+        # instead of a generator per level. Subclasses, e.g. ChunkedList,
+        # iterate over their items themselves.
+        if b is self._data:
+            self._new_iter = None
+        stack = []
+        decode = self._decode
+        offset, size = self._bounds(b)
+        while True:
+            if offset >= size:
+                if not stack:
+                    return
+                b, offset, size, decode = stack.pop()
+                continue
+            if start and b[offset] not in LAZY_PREFIXES:
+                offset = bencode.skip(b, offset)
+                start -= 1
+                continue
+            if self._cached and b is self._data and offset in self._cached:
+                item, offset = self._take_cached(offset)
+            else:
+                item, offset = decode(b, offset)
             if isinstance(item, BenLazyList):
-                for subitem in item:
-                    yield subitem
+                if start:
+                    num = len(item)
+                    if num <= start:
+                        start -= num
+                        continue
+                if type(item) is BenLazyList:
+                    stack.append((b, offset, size, decode))
+                    b = item._data
+                    decode = item._decode
+                    offset, size = self._bounds(b)
+                else:
+                    for subitem in item.skip(start):
+                        yield subitem
+                    start = 0
+            elif start:
+                start -= 1
             else:
                 yield item
 
+    def __reversed__(self):
+        return self.iter_reversed(self._data)
+
+    def _item_offsets(self, b, offset, size):
+        # offsets of consecutive items in b, found without decoding them
+        offsets = []
+        while offset < size:
+            offsets.append(offset)
+            offset = bencode.skip(b, offset)
+        return offsets
+
+    def iter_reversed(self, b):
+        # items of b oldest first
+        for offset in reversed(self._item_offsets(b, *self._bounds(b))):
+            item = self._decode(b, offset)[0]
+            if isinstance(item, BenLazyList):
+                for subitem in reversed(item):
+                    yield subitem
+            else:
+                yield item
@@ -1,4 +1,12 @@
 import traceback, threading, sys
+import cPickle
+from itertools import islice
+from multiprocessing import Process, Pipe
+from cStringIO import StringIO
+import widgets
+
+# number of items handed to a pipeline thread at once
+BATCH_SIZE = 1000
 
 class ExitPipeline(Exception):
     pass
@@ -7,7 +15,7 @@ class Pipeline(object):
     def __init__(self, pipeline):
         self.lock = threading.Condition(threading.Lock())
         self.thread = threading.Thread(target=self._run, args=(pipeline,))
-        self.item = None
+        self.items = None
         self.error = None
         self.active = False
         self.exit = False
@@ -28,11 +36,11 @@ class Pipeline(object):
                 # wait for the main thread to call next(), so we can
                 # release it properly below.
                 self.lock.acquire()
-                while self.item == None:
+                while self.items == None:
                     self.lock.wait()
             # case 2) crash occurs after 'yield item' moves control to
             # the other stages in the pipeline: release lock as if we
-            # had processed the item as usual.
+            # had processed the batch as usual.
             self.lock.notify()
             self.lock.release()
 
@@ -40,22 +48,23 @@ class Pipeline(object):
         while True:
             self.lock.acquire()
             self.active = True
-            while self.item == None:
+            while self.items == None:
                 self.lock.wait()
             if self.exit:
                 if self.error:
                     raise ExitPipeline()
                 else:
                     return
-            item = self.item
-            self.item = None
-            yield item
+            items = self.items
+            self.items = None
+            for item in items:
+                yield item
             self.lock.notify()
             self.lock.release()
 
-    def next(self, item):
+    def next(self, items):
         self.lock.acquire()
-        self.item = item
+        self.items = items
         self.lock.notify()
         self.lock.wait()
         self.lock.release()
@@ -63,7 +72,7 @@ class Pipeline(object):
 
     def close(self, error):
         self.lock.acquire()
-        self.item = True
+        self.items = True
         self.exit = True
         self.error = error
         self.lock.notify()
@@ -71,11 +80,151 @@ class Pipeline(object):
         self.thread.join()
         return self.error
 
-def run(source, pipelines):
+class ProcessPipeline(object):
+    # Runs a pipeline in a forked worker process. Batches of items are
+    # pickled once by the main process and streamed to the worker. When
+    # the pipeline finishes, the worker sends back the widgets, changes to
+    # the card text (see widgets.text_changes) and console output it
+    # produced, which are replayed in the main process. Other module state
+    # changed by the pipeline stays in the worker. If collect is True,
+    # items produced by the pipeline are sent back too.
+    def __init__(self, pipeline, collect=False):
+        inbox, self.inbox = Pipe(duplex=False)
+        self.outbox, outbox = Pipe(duplex=False)
+        self.result = None
+        self.process = Process(target=self._run,
+                               args=(pipeline, collect, inbox, outbox))
+        self.process.start()
+
+    def _run(self, pipeline, collect, inbox, outbox):
+        self.done = False
+        recorded = widgets.record()
+        text = widgets.text_state()
+        sys.stdout = stdout = StringIO()
+        error = None
+        items = []
+        try:
+            for x in pipeline(self._iter(inbox)):
+                if collect:
+                    items.append(x)
+            text = widgets.text_changes(text)
+        except:
+            error = traceback.format_exc()
+        outbox.send((error, recorded, text, stdout.getvalue(), items))
+        # the pipeline may stop early: keep reading until the end,
+        # so the main process never blocks on a full pipe.
+        while not self.done:
+            self.done = not inbox.recv_bytes()
+
+    def _iter(self, inbox):
+        while True:
+            data = inbox.recv_bytes()
+            if not data:
+                self.done = True
+                return
+            for item in cPickle.loads(data):
+                yield item
+
+    def _result(self):
+        if self.result is None:
+            try:
+                self.result = self.outbox.recv()
+            except EOFError:
+                self.result = ('Worker process exited unexpectedly\n',
+                               None,
+                               None,
+                               '',
+                               None)
+        return self.result
+
+    def next(self, data):
+        if self.result is None and self.outbox.poll():
+            self._result()
+        if self.result:
+            return self.result[0]
+        self.inbox.send_bytes(data)
+
+    def close(self):
+        self.inbox.send_bytes('')
+        error = self._result()[0]
+        self.process.join()
+        return error
+
+def run_processes(source, pipelines, batch_size=BATCH_SIZE):
+    def run(pipes):
+        for batch in batches(source, batch_size):
+            data = cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL)
+            for pipe in pipes:
+                error = pipe.next(data)
+                if error:
+                    return error
+        return False
+    pipes = [ProcessPipeline(p) for p in pipelines]
+    error = run(pipes)
+    for pipe in pipes:
+        error = pipe.close() or error
+    if error:
+        sys.stderr.write(error)
+        return False
+    for pipe in pipes:
+        error, recorded, text, stdout, items = pipe.result
+        widgets.replay(recorded)
+        widgets.apply_text_changes(text)
+        sys.stdout.write(stdout)
+    return True
+
+def run_sharded(source, pipeline, num_shards, shard_key,
+                batch_size=BATCH_SIZE):
+    # Splits source to num_shards disjoint shards by the hash of
+    # shard_key(item) and runs pipeline over each shard in a separate
+    # worker process. Returns a list of items produced by each worker,
+    # or None if any of them failed.
+    def run(pipes):
+        for batch in batches(source, batch_size):
+            shards = [[] for pipe in pipes]
+            for item in batch:
+                shards[hash(shard_key(item)) % num_shards].append(item)
+            for pipe, shard in zip(pipes, shards):
+                if shard:
+                    data = cPickle.dumps(shard, cPickle.HIGHEST_PROTOCOL)
+                    error = pipe.next(data)
+                    if error:
+                        return error
+        return False
+    pipes = [ProcessPipeline(pipeline, collect=True)\
+             for i in range(num_shards)]
+    error = run(pipes)
+    for pipe in pipes:
+        error = pipe.close() or error
+    if error:
+        sys.stderr.write(error)
+        return None
+    results = []
+    for pipe in pipes:
+        error, recorded, text, stdout, items = pipe.result
+        widgets.apply_text_changes(text)
+        sys.stdout.write(stdout)
+        results.append(items)
+    return results
+
+def batches(source, batch_size):
+    it = iter(source)
+    while True:
+        batch = list(islice(it, batch_size))
+        if batch:
+            yield batch
+        else:
+            return
+
+def run(source, pipelines, batch_size=BATCH_SIZE, executor='thread'):
+    # executor='process' runs each pipeline in its own worker process,
+    # so CPU-bound pipelines are not limited by the GIL.
+    if executor == 'process':
+        return run_processes(source, pipelines, batch_size)
     def run(pipes):
-        for item in source:
+        for batch in batches(source, batch_size):
             for pipe in pipes:
-                error = pipe.next(item)
+                error = pipe.next(batch)
                 if error:
                     return error
         return False
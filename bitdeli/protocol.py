@@ -1,39 +1,123 @@
+import io
 import os
 import sys
 import json
-from bencode import bencode
+import threading
+from Queue import Queue
+from bencode import bencode, BenCached
 from cbencode import Decoder
-from itertools import islice
+from itertools import islice, imap
 
 OUTPUT_CHUNK_SIZE = 16 * 1024 * 1024
+OUTPUT_BUFFER_ITEMS = 10000
+READ_BUFFER_SIZE = 1024 * 1024
 
 nonce = ''
-
-def entries(decoder=Decoder()):
-    while True:
-        for entry in communicate('next', decoder=decoder):
+# reentrant, so that the prefetching reader can hold it around a request
+lock = threading.RLock()
+
+def entries(decoder=Decoder(), prefetch=0):
+    # If prefetch > 0, up to prefetch batches of entries are requested
+    # and decoded in the background while the current batch is consumed.
+    if prefetch:
+        batches = prefetch_batches(decoder, prefetch)
+    else:
+        batches = iter(lambda: communicate('next', decoder=decoder), None)
+    for batch in batches:
+        for entry in batch:
             if len(entry) > 0:
                 yield entry[0], entry[1]
             else:
                 return
 
+def prefetch_batches(decoder, depth):
+    # The reader takes a slot before each request and the consumer frees
+    # it when it takes the batch, so at most depth batches are requested
+    # ahead. No request is sent after the consumer has stopped.
+    def read():
+        try:
+            while True:
+                slots.acquire()
+                with lock:
+                    if stopped.is_set():
+                        return
+                    batch = list(communicate('next', decoder=decoder))
+                queue.put((batch, None))
+                if not all(batch):
+                    return
+        except:
+            queue.put((None, sys.exc_info()))
+    slots = threading.Semaphore(depth)
+    stopped = threading.Event()
+    queue = Queue()
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch, exc_info = queue.get()
+            slots.release()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield batch
+    finally:
+        with lock:
+            stopped.set()
+        slots.release()
+
 def output(lst, chunked=False):
+    # Items are bencoded once and streamed to stdout as a bencoded list
+    # of strings, without building the whole message in memory. If chunked
+    # is True, the list is split to messages of about OUTPUT_CHUNK_SIZE
+    # bytes, so that only one chunk is kept in memory at a time.
     def next_chunk(it):
-        size = 0
-        while size < OUTPUT_CHUNK_SIZE:
-            enc = bencode(it.next())
-            size += len(enc)
-            yield enc
-    if chunked:
-        it = iter(lst)
-        while True:
-            chunk = list(next_chunk(it))
-            if chunk:
-                communicate('out', bencode(chunk))
-            else:
+        chunk = []
+        size = 2
+        for enc in it:
+            chunk.append(enc)
+            size += len(str(len(enc))) + 1 + len(enc)
+            if chunked and size >= OUTPUT_CHUNK_SIZE:
                 break
-    else:
-        communicate('out', bencode(map(bencode, lst)))
+        return chunk, size
+    def frame(chunk):
+        yield 'l'
+        for enc in chunk:
+            yield '%d:' % len(enc)
+            yield enc
+        yield 'e'
+    it = imap(bencode, lst)
+    while True:
+        chunk, size = next_chunk(it)
+        if chunk or not chunked:
+            send('out', frame(chunk), size)
+        if not (chunked and chunk):
+            break
+        del chunk
+
+class OutputBuffer(object):
+    # Collects items for output() and sends them in chunked messages
+    # when max_items items or max_bytes bytes have been collected. Items
+    # are bencoded when they are added. Call flush() to send the rest.
+    def __init__(self,
+                 max_items=OUTPUT_BUFFER_ITEMS,
+                 max_bytes=OUTPUT_CHUNK_SIZE):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = []
+        self.size = 0
+
+    def append(self, item):
+        enc = bencode(item)
+        self.items.append(BenCached(enc))
+        self.size += len(enc)
+        if len(self.items) >= self.max_items or self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.items:
+            output(self.items, chunked=True)
+            self.items = []
+            self.size = 0
 
 def done():
     return communicate('done')
@@ -58,33 +142,87 @@ class LogWriter(object):
             log(string)
 
 def communicate(head, body='', decoder=Decoder()):
-    sys.__stdout__.write('%s %s %d %s\n' % (nonce, head, len(body), body))
-    reply = recv()
+    return send(head, (body,), len(body), decoder)
+
+def send(head, parts, length, decoder=Decoder()):
+    # writes a message consisting of parts (strings) whose total length
+    # is length. Parts are written directly to buffered stdout.
+    with lock:
+        write = sys.__stdout__.write
+        write('%s %s %d ' % (nonce, head, length))
+        for part in parts:
+            write(part)
+        write('\n')
+        reply = recv()
     if reply:
         if reply[0] == 'l':
             return decoder.decode_iter(reply)
         else:
             return decoder.decode(reply)
 
-def read_int():
-    buf = ''
-    for i in range(11):
-        buf += sys.stdin.read(1)
-        if buf[-1] == ' ':
-            return int(buf)
-    raise Exception("System error: Invalid length (%s)" % buf)
+class FrameReader(object):
+    # Reads frames, '<nonce> <length> <body>', from a file descriptor
+    # with as few reads as possible. Data is read to the free space at the
+    # end of a buffer and bodies are returned as buffer objects that point
+    # to it, without copying. Since the space is never reused, a body stays
+    # valid after subsequent frames have been read: When the buffer fills
+    # up, a new one is allocated.
+    def __init__(self, fd=0, size=READ_BUFFER_SIZE):
+        self.file = io.FileIO(fd, closefd=False)
+        self.size = size
+        self.buf = bytearray()
+        self.start = self.end = 0
+
+    def _alloc(self, size):
+        buf = bytearray(max(size, self.size))
+        left = self.end - self.start
+        buf[:left] = self.buf[self.start:self.end]
+        self.buf = buf
+        self.start = 0
+        self.end = left
+
+    def _fill(self, size):
+        # make sure that at least size bytes are available after start
+        if self.start + size > len(self.buf):
+            self._alloc(size)
+        while self.end - self.start < size:
+            num = self.file.readinto(memoryview(self.buf)[self.end:])
+            if not num:
+                raise Exception("System error: Unexpected end of input")
+            self.end += num
+
+    def read(self):
+        # nonce is followed by at most 10 digits of length and a space
+        self._fill(6)
+        while True:
+            limit = min(self.end, self.start + 16)
+            space = self.buf.find(' ', self.start + 5, limit)
+            if space != -1:
+                break
+            if limit == self.start + 16:
+                raise Exception("System error: Invalid length (%s)" %\
+                                self.buf[self.start + 5:limit])
+            self._fill(self.end - self.start + 1)
+        nonce = str(self.buf[self.start:self.start + 4])
+        length = int(str(self.buf[self.start + 5:space]))
+        header = space + 1 - self.start
+        self._fill(header + length)
+        offset = self.start + header
+        self.start = offset + length
+        return nonce, buffer(self.buf, offset, length)
 
 def recv():
     global nonce
-    nonce = sys.stdin.read(5)[:4]
-    return sys.stdin.read(read_int())
+    nonce, body = reader.read()
+    return body
 
 def init():
-    global recv
+    global recv, reader
     if 'TESTING' not in os.environ:
         sys.stdout = LogWriter()
+        reader = FrameReader(sys.stdin.fileno())
         ret = recv()
-        if ret != '2:ok':
+        if str(ret) != '2:ok':
             raise Exception("System error: Invalid initial reply (%s)" % ret)
         ping()
     else:
@@ -121,6 +121,8 @@ THEMES =\
      "flamingo"]
 
 _widgets = OrderedDict()
+_groups = {}
+_recorded = None
 _title = None
 _description = None
 
@@ -181,6 +183,69 @@ def flush(output):
                  description=_description.flush() if _description else None)
         output(map(encode, chain([_meta], _widgets.itervalues())))
 
+def record():
+    """
+    Record widget output from now on. Returns a list that is populated with
+    `(group_id, widget)` tuples, which can be passed to :func:`replay` in
+    another process.
+    """
+    global _recorded
+    _recorded = []
+    return _recorded
+
+def replay(recorded):
+    """
+    Output widgets recorded by :func:`record` in the order they were created.
+    """
+    for group_id, kwargs in recorded:
+        group = _groups.get(group_id)
+        if kwargs['type'] == 'group':
+            # existing groups are updated by their members below
+            if kwargs['id'] not in _groups:
+                Group(group=group, id=kwargs['id'], layout=kwargs['layout'])
+        elif group:
+            group._add(kwargs)
+        else:
+            _widgets[kwargs['id']] = kwargs
+
+def text_state():
+    """
+    Returns the current card text and theme, and the values of
+    :class:`Title` and :class:`Description`, to be passed to
+    :func:`text_changes`.
+    """
+    def values(summary):
+        return dict(summary.values) if summary else {}
+    return (_title, _description,
+            dict(_meta), values(_title), values(_description))
+
+def text_changes(state):
+    """
+    Returns changes made to the card text, theme and summary values since
+    :func:`text_state` returned *state*, to be passed to
+    :func:`apply_text_changes` in another process. Raises *ValueError* if
+    :class:`Title` or :class:`Description` was created after that.
+    """
+    title, description, meta, title_values, description_values = state
+    if title is not _title or description is not _description:
+        raise ValueError("Title and Description must be created before "
+                         "running chains in worker processes")
+    def diff(old, new):
+        return dict((k, v) for k, v in new.iteritems()\
+                    if k not in old or old[k] != v)
+    now = text_state()
+    return (diff(meta, now[2]),
+            diff(title_values, now[3]),
+            diff(description_values, now[4]))
+
+def apply_text_changes(changes):
+    meta, title_values, description_values = changes
+    _meta.update(meta)
+    if _title:
+        _title.values.update(title_values)
+    if _description:
+        _description.values.update(description_values)
+
 def line_number():
     return [frame[2] for frame in inspect.stack() if frame[1] == MAIN][0]
 
@@ -232,6 +297,8 @@ class Widget(object):
 
     def output(self, kwargs):
         group = kwargs.pop('group', None)
+        if _recorded is not None:
+            _recorded.append((group.id if group else None, kwargs))
         if group:
             group._add(kwargs)
         else:
@@ -256,6 +323,7 @@ class Group(Widget):
         self.group = group
         self.layout = layout
         self.widgets = OrderedDict()
+        _groups[self.id] = self
         self._output()
 
     def _add(self, widget):
@@ -0,0 +1,152 @@
+"""
+:mod:`bitdeli.zdict`: Shared compression dictionaries
+======================================================
+
+Chunks of a :class:`bitdeli.chunkedlist.ChunkedList` are small and
+similar across profiles. Compressing them with a dictionary that contains
+typical content, e.g. common event names and field values, improves the
+compression ratio considerably.
+
+A dictionary is built from a sample of existing data with :func:`build`
+and identified by an id that is stored in the header of each chunk
+compressed with it. Dictionaries are loaded from :data:`DICTIONARY_DIR`
+on demand, or they can be registered explicitly with :func:`register`.
+
+To build a dictionary from a file of bencoded profiles, run
+
+.. code-block:: sh
+
+    python zdict.py profiles.bencode [output-dir]
+"""
+import os
+import zlib
+import hashlib
+from collections import Counter
+
+# zlib can refer back at most 32KB
+DICTIONARY_SIZE = 32768
+DICTIONARY_DIR = os.path.join(os.path.dirname(__file__), 'zdicts')
+SEGMENT_SIZE = 64
+GRAM_SIZE = 8
+
+_dictionaries = {}
+
+class Dictionary(object):
+    """
+    A zlib dictionary. Python 2 zlib doesn't support preset dictionaries,
+    so a compressor and a decompressor are primed with the dictionary
+    content once and copied for each chunk.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.id = hashlib.sha1(data).hexdigest()[:16]
+        self._compressor = zlib.compressobj(1)
+        prefix = self._compressor.compress(data) +\
+                 self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._decompressor = zlib.decompressobj()
+        self._decompressor.decompress(prefix)
+
+    def compress(self, x):
+        c = self._compressor.copy()
+        return c.compress(x) + c.flush()
+
+    def decompress(self, x):
+        d = self._decompressor.copy()
+        return d.decompress(x) + d.flush()
+
+def register(data):
+    """
+    Registers a dictionary with the content *data*. Returns a
+    :class:`Dictionary`.
+    """
+    zdict = Dictionary(data)
+    _dictionaries[zdict.id] = zdict
+    return zdict
+
+def get(dict_id):
+    """
+    Returns the :class:`Dictionary` with the id *dict_id*.
+    """
+    try:
+        return _dictionaries[dict_id]
+    except KeyError:
+        path = os.path.join(DICTIONARY_DIR, dict_id)
+        if not os.path.exists(path):
+            raise KeyError("Unknown compression dictionary (%s)" % dict_id)
+        return load(path)
+
+def load(path):
+    """
+    Registers a dictionary saved by :func:`save`.
+    """
+    f = open(path, 'rb')
+    try:
+        return register(f.read())
+    finally:
+        f.close()
+
+def save(zdict, directory=DICTIONARY_DIR):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    f = open(os.path.join(directory, zdict.id), 'wb')
+    try:
+        f.write(zdict.data)
+    finally:
+        f.close()
+
+def build(samples, size=DICTIONARY_SIZE):
+    """
+    Builds a dictionary of at most *size* bytes from *samples*, a list
+    of strings. The dictionary consists of segments of the samples that
+    contain most of the substrings common to many samples. Returns a
+    :class:`Dictionary`.
+    """
+    def grams(sample):
+        return set(sample[i:i + GRAM_SIZE]\
+                   for i in range(len(sample) - GRAM_SIZE + 1))
+    freqs = Counter()
+    for sample in samples:
+        freqs.update(grams(sample))
+    scored = {}
+    for sample in samples:
+        for i in range(0, len(sample), SEGMENT_SIZE):
+            segment = sample[i:i + SEGMENT_SIZE]
+            if segment not in scored:
+                scored[segment] = sum(freqs[gram] for gram in grams(segment))
+    segments = []
+    total = 0
+    seen = set()
+    for score, segment in sorted(((s, x) for x, s in scored.iteritems()),
+                                 reverse=True):
+        if total + len(segment) > size:
+            break
+        new = grams(segment) - seen
+        if len(new) > len(segment) / 2:
+            seen.update(new)
+            segments.append(segment)
+            total += len(segment)
+    # matches close to the data are the cheapest: best segments last
+    segments.reverse()
+    return register(''.join(segments))
+
+if __name__ == '__main__':
+    import sys, mmap
+    from itertools import islice
+    from bencode import bencode
+    from lazylist import BenLazyList
+    from cbencode import Decoder
+    from chunkedlist import ChunkedList
+    dec = Decoder(lazylist_obj=ChunkedList)
+    f = open(sys.argv[1], 'rb')
+    buf = mmap.mmap(f.fileno(), 0, mmap.PROT_READ, mmap.MAP_SHARED)
+    samples = []
+    for profile in dec.decode_iter(buf):
+        if isinstance(profile, list):
+            # (uid, profile) entries
+            profile = profile[-1]
+        for value in profile.itervalues():
+            if isinstance(value, BenLazyList):
+                samples.append(bencode(list(islice(value, 1000))))
+    zdict = build(samples)
+    save(zdict, *sys.argv[2:])
+    print zdict.id